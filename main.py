@@ -4,7 +4,8 @@ import asyncio
 import os
 import sys
 import platform
-import datetime as dt
+import time
+from collections import OrderedDict, deque
 from dataclasses import dataclass
 from pathlib import Path
 
@@ -13,7 +14,7 @@ from dotenv import load_dotenv
 from aiohttp import web
 
 from aiogram import Bot, Dispatcher, F
-from aiogram.filters import CommandStart, Command
+from aiogram.filters import CommandStart, Command, CommandObject
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 
 # -------- env / paths ----------
@@ -21,12 +22,12 @@ BASE_DIR = Path(__file__).resolve().parent
 load_dotenv(BASE_DIR / ".env", override=True)
 
 BOT_TOKEN = (os.getenv("BOT_TOKEN") or "").strip()
-ADMIN_IDS = {int(x) for x in (os.getenv("ADMIN_IDS", "")).split(",") if x.strip().isdigit()}
-BONUS_PER_REF = float(os.getenv("BONUS_PER_REF", "1.0"))
-PAYOUT_TARGET = int(os.getenv("PAYOUT_TARGET", "600"))
-SUB_CHANNELS_RAW = [ch.strip() for ch in os.getenv("SUB_CHANNELS", "").split(",") if ch.strip()]
-
 DATABASE_URL = os.getenv("DATABASE_URL", "").strip()  # postgresql://...sslmode=require
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "5"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "20"))
+# off — коммит не ждёт fsync WAL (при падении сервера теряются последние доли секунды записей,
+# целостность сохраняется); по умолчанию поведение сервера не меняем
+PG_SYNC_COMMIT = os.getenv("PG_SYNC_COMMIT", "").strip()
 
 def _to_chat_id(val: str) -> int | str:
     if val.startswith("@"):
@@ -36,17 +37,28 @@ def _to_chat_id(val: str) -> int | str:
     except ValueError:
         return val
 
-SUB_CHANNELS = [_to_chat_id(v) for v in SUB_CHANNELS_RAW]
+# настройки бота разбираются из окружения один раз при импорте
+@dataclass(frozen=True, slots=True)
+class Config:
+    admin_ids: frozenset[int]
+    bonus_per_ref: float
+    sub_channels_raw: tuple[str, ...]
+    sub_channels: tuple[int | str, ...]
+
+def _load_config() -> Config:
+    sub_channels_raw = tuple(ch.strip() for ch in os.getenv("SUB_CHANNELS", "").split(",") if ch.strip())
+    return Config(
+        admin_ids=frozenset(int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip().isdigit()),
+        bonus_per_ref=float(os.getenv("BONUS_PER_REF", "1.0")),
+        sub_channels_raw=sub_channels_raw,
+        sub_channels=tuple(_to_chat_id(v) for v in sub_channels_raw),
+    )
+
+CONFIG = _load_config()
 
 # -------- models ----------
-@dataclass
-class User:
-    user_id: int
-    username: str | None
-    ref_by: int | None
-    balance: float
-    referrals_count: int
-    joined_at: str
+# строка users как есть из asyncpg: user_id, username, ref_by, balance, referrals_count, joined_at
+User = asyncpg.Record
 
 # -------- schema ----------
 INIT_SQL = """
@@ -72,7 +84,111 @@ CREATE TABLE IF NOT EXISTS pending_refs (
     created_at TIMESTAMPTZ DEFAULT NOW()
 );
 
-CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer_id);
+-- последние приглашённые для /me: диапазон по индексу без сортировки
+DROP INDEX IF EXISTS idx_referrals_referrer;
+CREATE INDEX IF NOT EXISTS idx_referrals_referrer_created ON referrals(referrer_id, created_at DESC);
+
+-- /top читается индексом без сортировки и без обращений к heap
+CREATE INDEX IF NOT EXISTS idx_users_leaderboard
+    ON users(referrals_count DESC, balance DESC) INCLUDE (user_id, username);
+"""
+
+# -------- queries ----------
+# один текст на запрос: asyncpg кэширует подготовленные выражения по тексту SQL
+# в каждом соединении, так что все вызовы одного запроса попадают в одну запись кэша
+
+# upsert пользователя без холостой перезаписи строки: username обновляется, только если изменился
+# (иначе каждый /start плодит мёртвую версию строки и WAL). Когда UPDATE пропущен, RETURNING пуст —
+# тогда строку отдаёт me из users. xmax=0 только у только что вставленной строки
+SQL_ENSURE_USER = """
+WITH up AS (
+    INSERT INTO users(user_id, username) VALUES ($1, $2)
+    ON CONFLICT (user_id) DO UPDATE SET username=EXCLUDED.username
+    WHERE users.username IS DISTINCT FROM EXCLUDED.username
+    RETURNING (xmax = 0) AS is_new, user_id, username, ref_by, balance, referrals_count, joined_at
+), me AS (
+    SELECT * FROM up
+    UNION ALL
+    SELECT false, user_id, username, ref_by, balance, referrals_count, joined_at
+    FROM users WHERE user_id = $1 AND NOT EXISTS (SELECT 1 FROM up)
+)
+SELECT * FROM me
+"""
+
+SQL_GET_USER = "SELECT user_id, username, ref_by, balance, referrals_count, joined_at FROM users WHERE user_id=$1"
+
+# одним запросом: событие (уникальность по referred_id), ref_by у приглашённого,
+# начисление рефереру (строка реферера создаётся, если её ещё нет)
+SQL_APPLY_REFERRAL = """
+WITH ev AS (
+    INSERT INTO referrals(referrer_id, referred_id) VALUES ($1, $2)
+    ON CONFLICT (referred_id) DO NOTHING
+    RETURNING referrer_id
+), child AS (
+    UPDATE users SET ref_by = COALESCE(ref_by, $1)
+    WHERE user_id = $2 AND EXISTS (SELECT 1 FROM ev)
+)
+INSERT INTO users(user_id, referrals_count, balance)
+SELECT referrer_id, 1, $3::double precision FROM ev
+ON CONFLICT (user_id) DO UPDATE
+SET referrals_count = users.referrals_count + 1, balance = users.balance + EXCLUDED.balance
+RETURNING 1
+"""
+
+# для массовых вставок (импорт пользователей и т.п.) — conn.executemany с тем же SQL:
+# asyncpg конвейеризует все строки одним подготовленным выражением
+SQL_ADD_PENDING_REF = (
+    "INSERT INTO pending_refs(referred_id, referrer_id) VALUES ($1, $2) "
+    "ON CONFLICT (referred_id) DO UPDATE SET referrer_id=EXCLUDED.referrer_id"
+)
+
+# подтверждение подписки: забрать отложенного реферера и начислить рефералку одной транзакцией —
+# то же, что SQL_APPLY_REFERRAL, но реферер берётся из pending_refs
+SQL_CONFIRM_PENDING_REF = """
+WITH p AS (
+    DELETE FROM pending_refs WHERE referred_id = $1 RETURNING referrer_id
+), ev AS (
+    INSERT INTO referrals(referrer_id, referred_id)
+    SELECT referrer_id, $1 FROM p WHERE referrer_id <> $1
+    ON CONFLICT (referred_id) DO NOTHING
+    RETURNING referrer_id
+), child AS (
+    UPDATE users SET ref_by = COALESCE(ref_by, (SELECT referrer_id FROM ev))
+    WHERE user_id = $1 AND EXISTS (SELECT 1 FROM ev)
+), credit AS (
+    INSERT INTO users(user_id, referrals_count, balance)
+    SELECT referrer_id, 1, $2::double precision FROM ev
+    ON CONFLICT (user_id) DO UPDATE
+    SET referrals_count = users.referrals_count + 1, balance = users.balance + EXCLUDED.balance
+    RETURNING 1
+)
+SELECT (SELECT referrer_id FROM p) AS referrer_id, EXISTS (SELECT 1 FROM credit) AS applied
+"""
+
+# /me: профиль и последние 10 приглашённых за один round-trip, только чтение
+SQL_ME = """
+WITH last AS (
+    SELECT referred_id, created_at FROM referrals WHERE referrer_id=$1
+    ORDER BY created_at DESC LIMIT 10
+)
+SELECT user_id, username, ref_by, balance, referrals_count, joined_at,
+       ARRAY(SELECT referred_id FROM last ORDER BY created_at DESC, referred_id) AS ref_ids,
+       ARRAY(SELECT created_at FROM last ORDER BY created_at DESC, referred_id) AS ref_dates
+FROM users WHERE user_id=$1
+"""
+
+SQL_TOP10 = (
+    "SELECT user_id, username, referrals_count, balance "
+    "FROM users ORDER BY referrals_count DESC, balance DESC LIMIT 10"
+)
+
+# users сканируется один раз
+SQL_STATS = """
+WITH u AS (
+    SELECT COUNT(*) AS c, COALESCE(SUM(referrals_count),0) AS s, COALESCE(SUM(balance),0) AS b
+    FROM users
+)
+SELECT u.c, (SELECT COUNT(*) FROM referrals), u.s, u.b FROM u
 """
 
 # -------- db pool ----------
@@ -83,7 +199,21 @@ async def get_pool() -> asyncpg.Pool:
     if _pool is None:
         if not DATABASE_URL:
             raise RuntimeError("DATABASE_URL не задан (Render → Environment).")
-        _pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=5)
+        # JIT только добавляет задержку коротким OLTP-запросам бота
+        server_settings = {"application_name": "ubm-bot", "jit": "off"}
+        if PG_SYNC_COMMIT:
+            server_settings["synchronous_commit"] = PG_SYNC_COMMIT
+        # min_size соединений открывается сразу при создании пула — первый всплеск
+        # апдейтов не платит за TCP/TLS/startup
+        _pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=PG_POOL_MIN,
+            max_size=max(PG_POOL_MIN, PG_POOL_MAX),
+            max_inactive_connection_lifetime=300,
+            command_timeout=30,
+            statement_cache_size=200,
+            server_settings=server_settings,
+        )
     return _pool
 
 async def init_db():
@@ -91,174 +221,245 @@ async def init_db():
     async with pool.acquire() as conn:
         await conn.execute(INIT_SQL)
 
+async def close_pool() -> None:
+    # закрываем соединения явно, чтобы не оставлять занятые слоты на сервере при рестарте
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
 # -------- db ops ----------
 async def ensure_user(tg_user) -> tuple[bool, User]:
     pool = await get_pool()
     async with pool.acquire() as conn:
-        # upsert
-        await conn.execute(
-            """
-            INSERT INTO users(user_id, username) VALUES ($1, $2)
-            ON CONFLICT (user_id) DO UPDATE SET username=EXCLUDED.username
-            """,
-            tg_user.id, tg_user.username
-        )
-        row = await conn.fetchrow(
-            "SELECT user_id, username, ref_by, balance, referrals_count, joined_at FROM users WHERE user_id=$1",
-            tg_user.id
-        )
-    u = User(*row)
-    try:
-        joined = u.joined_at if isinstance(u.joined_at, dt.datetime) else dt.datetime.fromisoformat(str(u.joined_at))
-        is_new = (dt.datetime.utcnow() - joined.replace(tzinfo=None)).total_seconds() < 30
-    except Exception:
-        is_new = False
-    return is_new, u
+        row = await conn.fetchrow(SQL_ENSURE_USER, tg_user.id, tg_user.username)
+        if row is None:
+            # параллельная первая вставка того же пользователя: снимок запроса её не видел
+            row = await conn.fetchrow(SQL_ENSURE_USER, tg_user.id, tg_user.username)
+    return row["is_new"], row
 
 async def apply_referral(referrer_id: int, referred_id: int) -> bool:
     if referrer_id == referred_id:
         return False
     pool = await get_pool()
     async with pool.acquire() as conn:
-        async with conn.transaction():
-            # гарантируем реферера
-            await conn.execute(
-                "INSERT INTO users(user_id) VALUES ($1) ON CONFLICT (user_id) DO NOTHING",
-                referrer_id
-            )
-            # вставка события (уникальность по referred_id)
-            try:
-                await conn.execute(
-                    "INSERT INTO referrals(referrer_id, referred_id) VALUES ($1, $2)",
-                    referrer_id, referred_id
-                )
-            except asyncpg.UniqueViolationError:
-                return False
-
-            # ref_by у приглашённого — если ещё не привязан
-            await conn.execute(
-                "UPDATE users SET ref_by = COALESCE(ref_by, $1) WHERE user_id = $2",
-                referrer_id, referred_id
-            )
-            # начисление рефереру
-            await conn.execute(
-                "UPDATE users SET referrals_count = referrals_count + 1, balance = balance + $1 WHERE user_id = $2",
-                BONUS_PER_REF, referrer_id
-            )
+        result = await conn.fetchval(SQL_APPLY_REFERRAL, referrer_id, referred_id, CONFIG.bonus_per_ref)
+    if result is None:
+        return False
+    drop_top_cache()
     return True
 
 async def get_user(user_id: int) -> User | None:
     pool = await get_pool()
     async with pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT user_id, username, ref_by, balance, referrals_count, joined_at FROM users WHERE user_id=$1",
-            user_id
-        )
-        return User(*row) if row else None
+        return await conn.fetchrow(SQL_GET_USER, user_id)
 
 async def add_pending_ref(referred_id: int, referrer_id: int) -> None:
     pool = await get_pool()
     async with pool.acquire() as conn:
-        await conn.execute(
-            "INSERT INTO pending_refs(referred_id, referrer_id) VALUES ($1, $2) "
-            "ON CONFLICT (referred_id) DO UPDATE SET referrer_id=EXCLUDED.referrer_id",
-            referred_id, referrer_id
-        )
+        await conn.execute(SQL_ADD_PENDING_REF, referred_id, referrer_id)
 
-async def pop_pending_ref(referred_id: int) -> int | None:
+# отложенная рефералка подписавшегося: (реферер или None, начислено ли)
+async def confirm_pending_ref(referred_id: int) -> tuple[int | None, bool]:
     pool = await get_pool()
     async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT referrer_id FROM pending_refs WHERE referred_id=$1", referred_id)
-        if not row:
-            return None
-        await conn.execute("DELETE FROM pending_refs WHERE referred_id=$1", referred_id)
-        return row["referrer_id"]
+        referrer_id, applied = await conn.fetchrow(SQL_CONFIRM_PENDING_REF, referred_id, CONFIG.bonus_per_ref)
+    if applied:
+        drop_top_cache()
+    return referrer_id, applied
 
 async def get_top10():
     pool = await get_pool()
     async with pool.acquire() as conn:
-        rows = await conn.fetch(
-            "SELECT user_id, username, referrals_count, balance "
-            "FROM users ORDER BY referrals_count DESC, balance DESC LIMIT 10"
-        )
-        return rows
+        return await conn.fetch(SQL_TOP10)
 
 async def get_stats():
     pool = await get_pool()
     async with pool.acquire() as conn:
-        total_users = await conn.fetchval("SELECT COUNT(*) FROM users")
-        total_ref_events = await conn.fetchval("SELECT COUNT(*) FROM referrals")
-        total_refs_by_sum = await conn.fetchval("SELECT COALESCE(SUM(referrals_count),0) FROM users")
-        total_balance = await conn.fetchval("SELECT COALESCE(SUM(balance),0) FROM users")
+        total_users, total_ref_events, total_refs_by_sum, total_balance = await conn.fetchrow(SQL_STATS)
         return total_users, total_ref_events, total_refs_by_sum, float(total_balance or 0)
 
 # -------- bot helpers ----------
+_bot_username: str | None = None
+
 async def get_bot_username(bot: Bot) -> str:
-    me = await bot.get_me()
-    return me.username or ""
+    # username бота не меняется за время жизни процесса
+    global _bot_username
+    if _bot_username is None:
+        me = await bot.get_me()
+        _bot_username = me.username or ""
+    return _bot_username
+
+_PROFILE_TMPL = (
+    "👤 Вы: (@{username})\n"
+    "👥 Рефералов: <b>{refs}</b>\n"
+    "💰 Баланс: <b>{balance:.2f}</b>\n"
+)
+
+TOP_CACHE_TTL = 10.0
+# (monotonic-время истечения, готовый текст /top); сбрасывается при каждом начислении
+_top_cache: tuple[float, str] | None = None
+# растёт при каждом сбросе: пересборка, начатая до начисления, не должна сохранить устаревший топ
+_top_generation = 0
+
+def drop_top_cache() -> None:
+    global _top_cache, _top_generation
+    _top_cache = None
+    _top_generation += 1
+
+async def top_text() -> str:
+    global _top_cache
+    now = time.monotonic()
+    if _top_cache is not None and now < _top_cache[0]:
+        return _top_cache[1]
+    generation = _top_generation
+    rows = await get_top10()
+    if not rows:
+        text = "Пока нет данных 👀"
+    else:
+        lines = []
+        for i, r in enumerate(rows, start=1):
+            uid, username, refs, bal = r["user_id"], r["username"], r["referrals_count"], r["balance"]
+            uname = f"@{username}" if username else f"id:{uid}"
+            lines.append(f"{i}. {uname} — 👥 {refs} | 💰 {bal:.2f}")
+        text = "🏆 Топ-10:\n" + "\n".join(lines)
+    if generation == _top_generation:
+        _top_cache = (now + TOP_CACHE_TTL, text)
+    return text
 
 def profile_line(u: User) -> str:
-    need = max(0, PAYOUT_TARGET - u.referrals_count)
-    return (
-        f"👤 Вы: (@{u.username or '—'})\n"
-        f"👥 Рефералов: <b>{u.referrals_count}</b>\n"
-        f"💰 Баланс: <b>{u.balance:.2f}</b>\n"
-    )
+    return _PROFILE_TMPL.format(username=u["username"] or "—", refs=u["referrals_count"], balance=u["balance"])
+
+SUB_CACHE_TTL = 60.0
+# отсутствие подписки кэшируем коротко: только что подписавшийся должен пройти проверку почти сразу,
+# но серия нажатий «Проверил» не превращается в серию запросов к API
+SUB_CACHE_TTL_MISS = 3.0
+SUB_CACHE_MAX = 10_000
+# (user_id, chat_id) -> (подписан, monotonic-время истечения); LRU, не больше SUB_CACHE_MAX записей
+_sub_cache: OrderedDict[tuple[int, int | str], tuple[bool, float]] = OrderedDict()
 
 async def is_member_of(bot: Bot, chat_id: int | str, user_id: int) -> bool:
+    key = (user_id, chat_id)
+    cached = _sub_cache.get(key)
+    if cached is not None and time.monotonic() < cached[1]:
+        _sub_cache.move_to_end(key)
+        return cached[0]
     try:
         cm = await bot.get_chat_member(chat_id=chat_id, user_id=user_id)
     except Exception:
+        _sub_cache.pop(key, None)
         return False
-    return getattr(cm, "status", None) in ("member", "administrator", "creator")
+    ok = getattr(cm, "status", None) in ("member", "administrator", "creator")
+    _sub_cache[key] = (ok, time.monotonic() + (SUB_CACHE_TTL if ok else SUB_CACHE_TTL_MISS))
+    _sub_cache.move_to_end(key)
+    if len(_sub_cache) > SUB_CACHE_MAX:
+        _sub_cache.popitem(last=False)
+    return ok
 
 async def is_subscribed_everywhere(bot: Bot, user_id: int) -> bool:
-    if not SUB_CHANNELS:
+    if not CONFIG.sub_channels:
         return True
-    for ch in SUB_CHANNELS:
-        if not await is_member_of(bot, ch, user_id):
-            return False
-    return True
+    # первая же ненайденная подписка решает ответ — остальные запросы отменяем
+    tasks = [asyncio.create_task(is_member_of(bot, ch, user_id)) for ch in CONFIG.sub_channels]
+    try:
+        for fut in asyncio.as_completed(tasks):
+            if not await fut:
+                return False
+        return True
+    finally:
+        for task in tasks:
+            task.cancel()
 
-def sub_keyboard() -> InlineKeyboardMarkup:
+def _build_sub_keyboard() -> InlineKeyboardMarkup:
     buttons: list[list[InlineKeyboardButton]] = []
-    for ch in SUB_CHANNELS_RAW:
+    for ch in CONFIG.sub_channels_raw:
         url = f"https://t.me/{ch[1:]}" if ch.startswith("@") else "https://t.me/"
         buttons.append([InlineKeyboardButton(text=f"Подписаться: {ch}", url=url)])
     buttons.append([InlineKeyboardButton(text="✅ Проверил подписку", callback_data="check_sub")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+# список каналов не меняется — клавиатура собирается один раз
+_SUB_KEYBOARD = _build_sub_keyboard()
+
+def sub_keyboard() -> InlineKeyboardMarkup:
+    return _SUB_KEYBOARD
+
 async def notify_admins(bot: Bot, text: str) -> None:
-    for admin_id in ADMIN_IDS:
-        try:
-            await bot.send_message(admin_id, text, parse_mode="HTML")
-        except Exception:
-            pass
+    await asyncio.gather(
+        *(bot.send_message(admin_id, text, parse_mode="HTML") for admin_id in CONFIG.admin_ids),
+        return_exceptions=True,
+    )
+
+# фоновые задачи держим по сильной ссылке, иначе их может собрать GC
+_background_tasks: set[asyncio.Task] = set()
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
 
 # -------- auto-check (15s) ----------
-async def auto_check_after_delay(bot: Bot, user_id: int) -> None:
-    await asyncio.sleep(15)
-    if not await is_subscribed_everywhere(bot, user_id):
-        return
-    referrer_id = await pop_pending_ref(user_id)
-    if referrer_id is None:
+AUTO_CHECK_DELAY = 15.0
+# (monotonic-дедлайн, user_id); задержка у всех одинаковая, поэтому дедлайны
+# приходят по возрастанию и хватает FIFO — одна задача-воркер вместо задачи на пользователя
+_auto_check_queue: deque[tuple[float, int]] = deque()
+# последний дедлайн пользователя: повторный /start переносит проверку, а не добавляет ещё одну
+_auto_check_due: dict[int, float] = {}
+_auto_check_wakeup = asyncio.Event()
+
+def schedule_auto_check(user_id: int) -> None:
+    deadline = time.monotonic() + AUTO_CHECK_DELAY
+    _auto_check_due[user_id] = deadline
+    _auto_check_queue.append((deadline, user_id))
+    _auto_check_wakeup.set()
+
+async def auto_check_worker(bot: Bot) -> None:
+    while True:
+        if not _auto_check_queue:
+            _auto_check_wakeup.clear()
+            await _auto_check_wakeup.wait()
+            continue
+        delay = _auto_check_queue[0][0] - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        now = time.monotonic()
+        due: list[int] = []
+        while _auto_check_queue and _auto_check_queue[0][0] <= now:
+            deadline, user_id = _auto_check_queue.popleft()
+            # устаревшая запись: пользователь перезапланирован более поздним /start
+            if _auto_check_due.get(user_id) == deadline:
+                del _auto_check_due[user_id]
+                due.append(user_id)
+        # каждая проверка — отдельная задача: медленный Telegram/БД не задерживает следующие дедлайны
+        for user_id in due:
+            spawn(auto_check(bot, user_id))
+
+async def auto_check(bot: Bot, user_id: int) -> None:
+    try:
+        if not await is_subscribed_everywhere(bot, user_id):
+            return
+        referrer_id, applied = await confirm_pending_ref(user_id)
+    except Exception as e:
+        print(f"[auto-check] {user_id}: {e!r}", flush=True)
         return
-    applied = await apply_referral(referrer_id, user_id)
     if applied:
         try:
             await bot.send_message(user_id, "✅ Подписка подтверждена автоматически, рефералка начислена!")
         except Exception:
             pass
-        await notify_admins(
+        spawn(notify_admins(
             bot,
             f"🎉 Реферал (автопроверка 15с):\nРеферер: <code>{referrer_id}</code>\nПриглашённый: <code>{user_id}</code>"
-        )
+        ))
 
 # -------- aiohttp web (health) ----------
+HEALTH_BODY = b'{"ok": true}'
+
 async def health(request: web.Request):
-    return web.json_response({"ok": True})
+    return web.Response(body=HEALTH_BODY, content_type="application/json")
 
-async def run_web_app():
+async def start_web_app() -> web.AppRunner:
     app = web.Application()
     app.router.add_get("/", health)
     app.router.add_get("/health", health)
@@ -268,43 +469,42 @@ async def run_web_app():
     site = web.TCPSite(runner, "0.0.0.0", port)
     await site.start()
     print(f"[web] started on 0.0.0.0:{port}", flush=True)
-    # держим задачу живой
-    try:
-        while True:
-            await asyncio.sleep(3600)
-    except asyncio.CancelledError:
-        print("[web] shutting down...", flush=True)
-        raise
+    # сайт обслуживается циклом событий сам, отдельная задача-«держатель» не нужна
+    return runner
 
 # -------- dispatcher / handlers ----------
 dp = Dispatcher()
 
+COMMANDS_HELP = (
+    "Команды:\n• /ref — моя ссылка и счёт\n• /me — личная статистика\n• /top — топ-10\n"
+    "• /stats — общая статистика (для админов)\n• /check — проверить подписку"
+)
+# хвост ответа на /start: всё, кроме профиля и ссылки, неизменно
+START_TAIL_TMPL = "\n{profile}\n\n🔗 Твоя реф-ссылка:\n<code>{link}</code>\n\n" + COMMANDS_HELP
+
 @dp.message(CommandStart())
-async def on_start(message: Message, bot: Bot):
-    payload = ""
-    if message.text:
-        rest = message.text.strip()
-        if rest.startswith("/start"):
-            payload = rest.replace("/start", "", 1).strip()
-
-    is_new, u = await ensure_user(message.from_user)
-    subscribed = await is_subscribed_everywhere(bot, u.user_id)
+async def on_start(message: Message, command: CommandObject, bot: Bot):
+    payload = command.args or ""
+    referrer_id = int(payload) if payload.isdecimal() else None
+
+    # БД и Telegram API независимы — выполняем параллельно
+    (is_new, u), subscribed, bot_username = await asyncio.gather(
+        ensure_user(message.from_user),
+        is_subscribed_everywhere(bot, message.from_user.id),
+        get_bot_username(bot),
+    )
     ref_applied = False
-    referrer_id: int | None = None
 
-    if payload and payload.isdigit():
-        referrer_id = int(payload)
-        if referrer_id != u.user_id:
-            if subscribed:
-                ref_applied = await apply_referral(referrer_id, u.user_id)
-            else:
-                await add_pending_ref(u.user_id, referrer_id)
+    if referrer_id is not None and referrer_id != u["user_id"]:
+        if subscribed:
+            ref_applied = await apply_referral(referrer_id, u["user_id"])
+        else:
+            await add_pending_ref(u["user_id"], referrer_id)
 
-    bot_username = await get_bot_username(bot)
-    link = f"https://t.me/{bot_username}?start={u.user_id}" if bot_username else "—"
+    link = f"https://t.me/{bot_username}?start={u['user_id']}" if bot_username else "—"
 
     parts = ["👋 Добро пожаловать!"]
-    if not subscribed and SUB_CHANNELS:
+    if not subscribed and CONFIG.sub_channels:
         parts += ["Чтобы пользоваться ботом и получить реферал-бонус — подпишись на каналы ниже:", ""]
     else:
         parts.append("Готово, ты можешь пользоваться ботом.")
@@ -312,41 +512,39 @@ async def on_start(message: Message, bot: Bot):
     if ref_applied:
         parts.append("✅ Твоя рефералка засчитана!")
         if referrer_id is not None:
-            await notify_admins(
+            spawn(notify_admins(
                 bot,
-                f"🎉 Новый реферал!\nРеферер: <code>{referrer_id}</code>\nПриглашённый: <code>{u.user_id}</code>"
-            )
-    elif payload and payload.isdigit() and not subscribed and SUB_CHANNELS:
+                f"🎉 Новый реферал!\nРеферер: <code>{referrer_id}</code>\nПриглашённый: <code>{u['user_id']}</code>"
+            ))
+    elif referrer_id is not None and not subscribed and CONFIG.sub_channels:
         parts.append("ℹ️ Рефералка будет засчитана после подписки и автопроверки/кнопки.")
     else:
         parts.append("ℹ️ Начисление по реф-ссылке происходит один раз при первом старте.")
 
-    parts += ["", profile_line(u), "", f"🔗 Твоя реф-ссылка:\n<code>{link}</code>", "",
-              "Команды:\n• /ref — моя ссылка и счёт\n• /me — личная статистика\n• /top — топ-10\n• /stats — общая статистика (для админов)\n• /check — проверить подписку"]
+    parts.append(START_TAIL_TMPL.format(profile=profile_line(u), link=link))
 
     text = "\n".join(parts)
-    if not subscribed and SUB_CHANNELS:
+    if not subscribed and CONFIG.sub_channels:
         await message.answer(text, parse_mode="HTML", reply_markup=sub_keyboard())
     else:
         await message.answer(text, parse_mode="HTML")
 
-    if not subscribed and SUB_CHANNELS:
-        asyncio.create_task(auto_check_after_delay(bot, u.user_id))
+    if not subscribed and CONFIG.sub_channels:
+        schedule_auto_check(u["user_id"])
 
 @dp.message(Command("check"))
 async def cmd_check(message: Message, bot: Bot):
     user_id = message.from_user.id
     subscribed = await is_subscribed_everywhere(bot, user_id)
     if subscribed:
-        referrer_id = await pop_pending_ref(user_id)
+        referrer_id, applied = await confirm_pending_ref(user_id)
         if referrer_id is not None:
-            applied = await apply_referral(referrer_id, user_id)
             if applied:
                 await message.answer("✅ Подписка подтверждена, рефералка начислена!")
-                await notify_admins(
+                spawn(notify_admins(
                     bot,
                     f"🎉 Реферал (после проверки):\nРеферер: <code>{referrer_id}</code>\nПриглашённый: <code>{user_id}</code>"
-                )
+                ))
             else:
                 await message.answer("✅ Подписка подтверждена. Рефералка уже была начислена ранее.")
         else:
@@ -359,15 +557,14 @@ async def cb_check_sub(call: CallbackQuery, bot: Bot):
     user_id = call.from_user.id
     subscribed = await is_subscribed_everywhere(bot, user_id)
     if subscribed:
-        referrer_id = await pop_pending_ref(user_id)
+        referrer_id, applied = await confirm_pending_ref(user_id)
         if referrer_id is not None:
-            applied = await apply_referral(referrer_id, user_id)
             if applied:
                 await call.message.edit_text("✅ Подписка подтверждена, рефералка начислена!")
-                await notify_admins(
+                spawn(notify_admins(
                     bot,
                     f"🎉 Реферал (после кнопки):\nРеферер: <code>{referrer_id}</code>\nПриглашённый: <code>{user_id}</code>"
-                )
+                ))
             else:
                 await call.message.edit_text("✅ Подписка подтверждена. Рефералка уже была начислена ранее.")
         else:
@@ -377,49 +574,34 @@ async def cb_check_sub(call: CallbackQuery, bot: Bot):
 
 @dp.message(Command("ref"))
 async def cmd_ref(message: Message, bot: Bot):
-    u = await get_user(message.from_user.id)
+    u, bot_username = await asyncio.gather(get_user(message.from_user.id), get_bot_username(bot))
     if not u:
         is_new, u = await ensure_user(message.from_user)
-    bot_username = await get_bot_username(bot)
-    link = f"https://t.me/{bot_username}?start={u.user_id}" if bot_username else "—"
+    link = f"https://t.me/{bot_username}?start={u['user_id']}" if bot_username else "—"
     await message.answer(f"{profile_line(u)}\n\n🔗 Твоя реф-ссылка:\n<code>{link}</code>", parse_mode="HTML")
 
 @dp.message(Command("me"))
 async def cmd_me(message: Message):
     pool = await get_pool()
     async with pool.acquire() as conn:
-        # ensure user
-        await conn.execute(
-            "INSERT INTO users(user_id, username) VALUES ($1,$2) ON CONFLICT (user_id) DO UPDATE SET username=EXCLUDED.username",
-            message.from_user.id, message.from_user.username
-        )
-        row = await conn.fetchrow("SELECT user_id, username, ref_by, balance, referrals_count, joined_at FROM users WHERE user_id=$1", message.from_user.id)
-        u = User(*row)
-        rows = await conn.fetch(
-            "SELECT referred_id, created_at FROM referrals WHERE referrer_id=$1 ORDER BY created_at DESC",
-            u.user_id
-        )
-    last_lines = "\n".join([f"• <code>{r['referred_id']}</code> ({r['created_at']})" for r in rows[:10]]) if rows else "пока никого"
+        u = await conn.fetchrow(SQL_ME, message.from_user.id)
+    if u is None:
+        # пользователь ещё не заходил через /start — заводим и перечитываем
+        await ensure_user(message.from_user)
+        async with pool.acquire() as conn:
+            u = await conn.fetchrow(SQL_ME, message.from_user.id)
+    last_lines = "\n".join(
+        f"• <code>{referred_id}</code> ({created_at})"
+        for referred_id, created_at in zip(u["ref_ids"], u["ref_dates"])
+    ) or "пока никого"
     await message.answer(f"{profile_line(u)}\n\nПоследние приглашённые:\n{last_lines}", parse_mode="HTML")
 
 @dp.message(Command("top"))
 async def cmd_top(message: Message):
-    rows = await get_top10()
-    if not rows:
-        await message.answer("Пока нет данных 👀")
-        return
-    lines = []
-    for i, r in enumerate(rows, start=1):
-        uid, username, refs, bal = r["user_id"], r["username"], r["referrals_count"], r["balance"]
-        uname = f"@{username}" if username else f"id:{uid}"
-        lines.append(f"{i}. {uname} — 👥 {refs} | 💰 {bal:.2f}")
-    await message.answer("🏆 Топ-10:\n" + "\n".join(lines))
+    await message.answer(await top_text())
 
-@dp.message(Command("stats"))
+@dp.message(Command("stats"), F.from_user.id.in_(CONFIG.admin_ids))
 async def cmd_stats(message: Message):
-    if message.from_user.id not in ADMIN_IDS:
-        await message.answer("Эта команда только для админов.")
-        return
     total_users, total_ref_events, total_refs_by_sum, total_balance = await get_stats()
     await message.answer(
         "📊 Общая статистика:\n"
@@ -430,6 +612,10 @@ async def cmd_stats(message: Message):
         parse_mode="HTML",
     )
 
+@dp.message(Command("stats"))
+async def cmd_stats_denied(message: Message):
+    await message.answer("Эта команда только для админов.")
+
 # -------- run ----------
 async def main():
     print("[boot] python:", sys.version, flush=True)
@@ -443,16 +629,27 @@ async def main():
     await init_db()  # создадим таблицы, если их ещё нет
 
     # стартуем веб (порт для Render)
-    web_task = asyncio.create_task(run_web_app())
+    runner = await start_web_app()
 
     bot = Bot(BOT_TOKEN)
+    await get_bot_username(bot)  # прогреваем кэш до первого апдейта
     print("[boot] starting bot & web...", flush=True)
 
-    await asyncio.gather(
-        dp.start_polling(bot),
-        web_task,
-    )
+    worker_task = asyncio.create_task(auto_check_worker(bot))
+    try:
+        # aiogram сам ловит SIGINT/SIGTERM и возвращается из polling
+        await dp.start_polling(bot)
+    finally:
+        worker_task.cancel()
+        print("[web] shutting down...", flush=True)
+        await runner.cleanup()
+        await close_pool()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        import uvloop  # нет под Windows — там остаётся стандартный цикл
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main())
 